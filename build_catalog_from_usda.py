@@ -1,17 +1,53 @@
 #!/usr/bin/env python3
 # build_catalog_from_usda.py — QUICK MODE + caching + pasta dry→cooked + safe fallbacks + pinned overrides
 
-import json, os, sys, time, random, requests
+import json, os, re, sys, time, random, sqlite3, threading, requests
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import lru_cache, wraps
 from requests.exceptions import HTTPError, ReadTimeout, ConnectionError
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 
+try:   # orjson is 2-5x faster on the multi-MB cache/catalog; stdlib json is the fallback
+    import orjson
+    def json_loads(data):
+        return orjson.loads(data)
+    def json_dumps(obj, indent=False):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode()
+except ImportError:
+    def json_loads(data):
+        return json.loads(data)
+    def json_dumps(obj, indent=False):
+        return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False)   # raw UTF-8, like orjson
+
+def _fold_plural(word):
+    if len(word) > 4 and word.endswith("ies"): return word[:-3] + "y"
+    if len(word) > 4 and word.endswith("oes"): return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"): return word[:-1]
+    return word
+
+try:   # nltk is optional; plural folding covers most seed names without it
+    from nltk.stem import PorterStemmer, WordNetLemmatizer
+    _stem = PorterStemmer().stem
+    try:
+        _lemmatize = WordNetLemmatizer().lemmatize
+        _lemmatize("beans")   # LookupError until the wordnet corpus is downloaded
+    except LookupError:
+        _lemmatize = _fold_plural
+except ImportError:
+    _stem = _lemmatize = _fold_plural
+
 API_KEY   = os.environ.get("FDC_API_KEY") or "NuhSiWOGwnfXb7cNTTGYsGfHAtK0lyKi7WQ3sz3y"
 SEED      = "catalog.seed.json"
 OUT       = "catalog.json"
-CACHE     = "usda_cache.json"
+PARTIAL   = OUT + ".partial.jsonl"   # one line per finished item; lets a crashed run resume
+CACHE     = "usda_cache.sqlite3"
+LEGACY_CACHE = "usda_cache.json"   # pre-SQLite cache, ingested once on first run
 API_BASE  = "https://api.nal.usda.gov/fdc/v1"
 QUICK_MODE= ("--quick" in sys.argv) or (os.environ.get("QUICK") == "1")
+REFRESH_MODE = ("--refresh" in sys.argv) or (os.environ.get("REFRESH") == "1")   # revalidate cached foods
+MAX_WORKERS = int(os.environ.get("FDC_WORKERS") or 12)
+RATE_PER_HOUR = float(os.environ.get("FDC_RATE_PER_HOUR") or 1000)   # USDA default key limit
 
 # ---------- precise search hints (helps stubborn items land on correct cooked entries) ----------
 NAME_HINTS = {
@@ -78,21 +114,111 @@ PINNED_OVERRIDES = {
     "barilla_protein_plus_pasta_cooked": {"kcal": 155.0, "protein": 10.0},
 }
 
-# ---------- caching ----------
-def load_cache():
-    if not os.path.exists(CACHE):
-        return {"food_by_id":{}, "search":{}}
+# ---------- caching (SQLite: rows are written as they are fetched, so a crash keeps progress) ----------
+_DB_LOCAL = threading.local()   # one connection per worker thread; WAL lets them read concurrently
+CACHE_TABLES = {"food": "id", "search": "key"}
+
+def _db():
+    conn = getattr(_DB_LOCAL, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(CACHE, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        _DB_LOCAL.conn = conn
+    return conn
+
+def cache_get(table, key):
+    row = _db().execute(f"SELECT json FROM {table} WHERE {CACHE_TABLES[table]}=?", (key,)).fetchone()
+    return json_loads(row[0]) if row else None
+
+def cache_put(table, key, value):
+    conn = _db()
+    with conn:
+        conn.execute(f"INSERT OR REPLACE INTO {table} ({CACHE_TABLES[table]}, json) VALUES (?,?)",
+                     (key, json_dumps(value)))
+
+def cache_get_food(key):
+    """(data, etag, last_modified) for a cached food, or None."""
+    row = _db().execute("SELECT json, etag, last_modified FROM food WHERE id=?", (key,)).fetchone()
+    return (json_loads(row[0]), row[1], row[2]) if row else None
+
+FRESH_FOOD_IDS = set()   # food rows written during this run; --refresh doesn't revalidate them
+
+def cache_put_food(key, value, etag=None, last_modified=None):
+    conn = _db()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO food (id, json, etag, last_modified) VALUES (?,?,?,?)",
+                     (key, json_dumps(value), etag, last_modified))
+    FRESH_FOOD_IDS.add(key)
+
+def migrate_legacy_cache(conn):
     try:
-        with open(CACHE,"r") as f:
-            return json.load(f)
+        with open(LEGACY_CACHE,"rb") as f:
+            legacy = json_loads(f.read())
     except Exception:
-        return {"food_by_id":{}, "search":{}}
-
-def save_cache(cache):
-    with open(CACHE,"w") as f:
-        json.dump(cache, f, indent=2)
-
-CACHE_DB = load_cache()
+        return
+    foods = legacy.get("food_by_id", {}); searches = legacy.get("search", {})
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO food (id, json) VALUES (?,?)",
+                         ((k, json_dumps(v)) for k, v in foods.items()))
+        conn.executemany("INSERT OR REPLACE INTO search (key, json) VALUES (?,?)",
+                         ((_canonical_search_key(k), json_dumps(v)) for k, v in searches.items()))
+    print(f"[CACHE] migrated {len(foods)} foods + {len(searches)} searches from {LEGACY_CACHE}")
+
+def search_cache_key(name, datasets, page_size):
+    # datasets are sorted so every prefer order shares one cached search
+    return f"{name}||{'|'.join(sorted(datasets))}||{page_size}"
+
+def _canonical_search_key(key):
+    try:
+        name, datasets, page_size = key.rsplit("||", 2)
+    except ValueError:
+        return key
+    return search_cache_key(name, datasets.split("|"), page_size)
+
+def init_cache():
+    conn = _db()
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS food (id TEXT PRIMARY KEY, json TEXT, etag TEXT, last_modified TEXT)")
+        conn.execute("CREATE TABLE IF NOT EXISTS search (key TEXT PRIMARY KEY, json TEXT)")
+        cols = {row[1] for row in conn.execute("PRAGMA table_info(food)")}
+        for col in ("etag", "last_modified"):   # databases created before conditional GETs
+            if col not in cols: conn.execute(f"ALTER TABLE food ADD COLUMN {col} TEXT")
+    empty = not any(conn.execute(f"SELECT 1 FROM {t} LIMIT 1").fetchone() for t in CACHE_TABLES)
+    if empty and os.path.exists(LEGACY_CACHE):
+        migrate_legacy_cache(conn)
+
+init_cache()
+
+# ---------- thread-pool helpers (log lines are shared across workers) ----------
+_PRINT_LOCK = threading.Lock()
+
+def log(msg):
+    with _PRINT_LOCK:
+        print(msg)
+
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+def single_flight(fn):
+    """Concurrent calls with the same args wait on the first caller's result instead of refetching."""
+    @wraps(fn)
+    def wrapper(*args):
+        key = (fn.__name__, args)
+        with _INFLIGHT_LOCK:
+            fut = _INFLIGHT.get(key)
+            owner = fut is None
+            if owner:
+                fut = _INFLIGHT[key] = Future()
+        if owner:
+            try:
+                fut.set_result(fn(*args))
+            except BaseException as e:
+                fut.set_exception(e)
+            finally:
+                with _INFLIGHT_LOCK:
+                    _INFLIGHT.pop(key, None)
+        return fut.result()
+    return wrapper
 
 # ---------- HTTP session (fast in QUICK mode) ----------
 def build_session():
@@ -101,34 +227,62 @@ def build_session():
                       status_forcelist=(429,500,502,503,504),
                       allowed_methods=frozenset(["GET"]), raise_on_status=False)
         timeouts = (5, 15)
-        sleep_min, sleep_span = 0.06, 0.04
     else:
         retry = Retry(total=6, connect=4, read=4, backoff_factor=0.8,
                       status_forcelist=(429,500,502,503,504),
                       allowed_methods=frozenset(["GET"]), raise_on_status=False)
         timeouts = (10, 60)
-        sleep_min, sleep_span = 0.18, 0.10
     s = requests.Session()
-    s.mount("https://", HTTPAdapter(max_retries=retry))
-    s.mount("http://",  HTTPAdapter(max_retries=retry))
+    # pool sized past MAX_WORKERS so every worker keeps a warm keep-alive connection
+    pool = max(32, MAX_WORKERS)
+    s.mount("https://", HTTPAdapter(max_retries=retry, pool_connections=pool, pool_maxsize=pool))
+    s.mount("http://",  HTTPAdapter(max_retries=retry, pool_connections=pool, pool_maxsize=pool))
     s._timeouts = timeouts
-    s._sleep_min = sleep_min
-    s._sleep_span = sleep_span
     return s
 
 SESSION = build_session()
 
-def _sleep():
-    time.sleep(SESSION._sleep_min + random.uniform(0, SESSION._sleep_span))
-
-def _get(url, **params):
+# ---------- rate limiting (only real HTTP calls take a token; cache hits never block) ----------
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate, self.capacity = rate, capacity   # tokens/sec, max burst
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self.cond.wait((1 - self.tokens) / self.rate)
+
+RATE_LIMIT = TokenBucket(RATE_PER_HOUR / 3600.0, capacity=100)
+
+HTTP_STATS = {"calls": 0, "seconds": 0.0, "not_modified": 0}   # successful USDA calls, request + decode time
+_STATS_LOCK = threading.Lock()
+
+def _request(method, url, body=None, headers=None, **params):
+    """Returns (response, parsed body); the body is None on 304 Not Modified."""
     params = {"api_key": API_KEY, **params}
     tries, delay = 0, 0.5 if QUICK_MODE else 0.75
     while True:
         try:
-            r = SESSION.get(url, params=params, timeout=SESSION._timeouts)
+            RATE_LIMIT.acquire()
+            t0 = time.perf_counter()
+            r = SESSION.request(method, url, params=params, json=body, headers=headers, timeout=SESSION._timeouts)
             r.raise_for_status()
-            return r.json()
+            not_modified = r.status_code == 304
+            data = None if not_modified else json_loads(r.content)   # raw bytes straight into orjson, no text decode
+            with _STATS_LOCK:
+                HTTP_STATS["calls"] += 1
+                HTTP_STATS["not_modified"] += not_modified
+                HTTP_STATS["seconds"] += time.perf_counter() - t0
+            return r, data
         except (ReadTimeout, ConnectionError, HTTPError):
             tries += 1
             if tries >= (3 if QUICK_MODE else 5):
@@ -136,75 +290,151 @@ def _get(url, **params):
             time.sleep(delay + random.uniform(0, 0.25))
             delay *= 1.6
 
-# ---------- USDA helpers with cache ----------
+def _get(url, **params):
+    return _request("GET", url, **params)[1]
+
+def _post(url, body, **params):
+    return _request("POST", url, body, **params)[1]
+
+def _get_conditional(url, etag=None, last_modified=None, **params):
+    """GET with If-None-Match/If-Modified-Since; returns (data or None if unchanged, etag, last_modified)."""
+    headers = {}
+    if etag: headers["If-None-Match"] = etag
+    if last_modified: headers["If-Modified-Since"] = last_modified
+    r, data = _request("GET", url, headers=headers or None, **params)
+    if data is None:   # 304: the stored body and its validators still hold
+        return None, r.headers.get("ETag") or etag, r.headers.get("Last-Modified") or last_modified
+    return data, r.headers.get("ETag"), r.headers.get("Last-Modified")   # new body: only its own validators
+
+# ---------- USDA helpers with cache (in-memory LRU → SQLite → network) ----------
+# results are shared between callers: treat them as read-only
 def fetch_by_id(fdc_id):
-    key = str(fdc_id)
-    if key in CACHE_DB["food_by_id"]:
-        return CACHE_DB["food_by_id"][key]
-    data = _get(f"{API_BASE}/food/{fdc_id}")
-    CACHE_DB["food_by_id"][key] = data
+    return _fetch_food(str(fdc_id))
+
+@lru_cache(maxsize=4096)
+@single_flight
+def _fetch_food(key):
+    cached = cache_get_food(key)
+    if cached is not None and (not REFRESH_MODE or key in FRESH_FOOD_IDS):
+        return cached[0]
+    # miss → plain GET that records validators; REFRESH → cheap 304 revalidation when we have them
+    prev, etag, last_modified = cached or (None, None, None)
+    data, etag, last_modified = _get_conditional(f"{API_BASE}/food/{key}", etag, last_modified,
+                                                 format="abridged", nutrients=NEEDED_NUTRIENTS)
+    if data is None:
+        return prev
+    cache_put_food(key, data, etag, last_modified)
     return data
 
-def search_by_name(name, datasets, page_size=30):
-    cache_key = f"{name}||{'|'.join(datasets)}||{page_size}"
-    if cache_key in CACHE_DB["search"]:
-        return CACHE_DB["search"][cache_key]
-    all_foods = []
-    for dt in datasets:
+BULK_IDS_MAX = 20   # POST /foods accepts up to 20 fdcIds per call
+
+def fetch_bulk(ids):
+    """Warm the food cache for the given fdcIds, BULK_IDS_MAX per round trip."""
+    missing = [k for k in dict.fromkeys(str(i) for i in ids) if k.isdigit() and cache_get("food", k) is None]
+    for i in range(0, len(missing), BULK_IDS_MAX):
+        chunk = missing[i:i+BULK_IDS_MAX]
         try:
-            res = _get(f"{API_BASE}/foods/search", query=name, dataType=dt, pageSize=page_size)
-            all_foods.extend(res.get("foods", []) or [])
-        except HTTPError:
+            foods = _post(f"{API_BASE}/foods", {"fdcIds": [int(k) for k in chunk], "format": "abridged",
+                                                "nutrients": [int(n) for n in NEEDED_NUTRIENTS.split(",")]})
+        except (ReadTimeout, ConnectionError, HTTPError):
+            log(f"[BULK] fetch failed for {len(chunk)} id(s); falling back to per-id lookups")
             continue
-    CACHE_DB["search"][cache_key] = all_foods
+        for food in foods or []:
+            cache_put_food(str(food.get("fdcId")), food)
+
+def search_by_name(name, datasets, page_size=30):
+    # dataset preference is applied by layer1_match; a failed search is caught here, outside the
+    # lru_cache, so the next call for the same query retries instead of replaying the failure
+    try:
+        return _search(name, tuple(sorted(datasets)), page_size)
+    except HTTPError:
+        return []
+
+@lru_cache(maxsize=4096)
+@single_flight
+def _search(name, datasets, page_size):
+    cache_key = search_cache_key(name, datasets, page_size)
+    cached = cache_get("search", cache_key)
+    if cached is not None:
+        return cached
+    # one call across all datasets (requests sends the list as repeated dataType params); page_size is
+    # per dataset, so the combined page is scaled up to keep the old candidate pool (API max 200)
+    res = _get(f"{API_BASE}/foods/search", query=name, dataType=list(datasets),
+               pageSize=min(page_size * len(datasets), 200))
+    all_foods = res.get("foods", []) or []
+    cache_put("search", cache_key, all_foods)
     return all_foods
 
 # ---------- nutrient extraction ----------
+ENERGY_KCAL = frozenset(("1008", "208"))   # FDC nutrient id / legacy SR number
+PROTEIN_G   = frozenset(("1003", "203"))
+
+# only these come back from the USDA calls: kcal, protein, and Atwater energy for Foundation foods
+NEEDED_NUTRIENTS = "203,208,957,958"
+
 def per100_from_food(food):
-    kcal = None; protein = None
-    for n in food.get("foodNutrients", []):
-        num  = n.get("nutrient",{}).get("number") or n.get("nutrientNumber")
-        unit = (n.get("nutrient",{}).get("unitName") or "").lower()
-        amt  = n.get("amount")
+    # handles full (nested "nutrient") and abridged (flat number/amount) food records; search hits
+    # (flat nutrientId/value) are left unread so candidate ranking stays driven by the name match
+    # single pass: exact nutrient id/number wins; first by-name match is the fallback
+    kcal = protein = kcal_nm = protein_nm = None
+    for n in food.get("foodNutrients", ()):
+        amt = n.get("amount")
         if amt is None: continue
-        if str(num) == "1008" and unit in ("kcal","kcals"): kcal = amt
-        if str(num) == "1003" and unit == "g":              protein = amt
-    if kcal is None or protein is None:
-        for n in food.get("foodNutrients", []):
-            nm   = (n.get("nutrient",{}).get("name") or "").lower()
-            unit = (n.get("nutrient",{}).get("unitName") or "").lower()
-            amt  = n.get("amount")
-            if amt is None: continue
-            if kcal is None and "energy" in nm and unit in ("kcal","kcals"): kcal = amt
-            if protein is None and "protein" in nm and unit == "g":          protein = amt
-    return kcal, protein
+        nut  = n.get("nutrient") or n
+        get  = nut.get
+        unit = (get("unitName") or "").lower()
+        if unit in ("kcal","kcals"):
+            if str(get("id") or n.get("nutrientId")) in ENERGY_KCAL or str(get("number") or n.get("nutrientNumber")) in ENERGY_KCAL:
+                kcal = amt
+            elif kcal_nm is None and "energy" in (get("name") or "").lower():
+                kcal_nm = amt
+        elif unit == "g":
+            if str(get("id") or n.get("nutrientId")) in PROTEIN_G or str(get("number") or n.get("nutrientNumber")) in PROTEIN_G:
+                protein = amt
+            elif protein_nm is None and "protein" in (get("name") or "").lower():
+                protein_nm = amt
+        if kcal is not None and protein is not None: break
+    return (kcal if kcal is not None else kcal_nm), (protein if protein is not None else protein_nm)
 
 # ---------- plausibility ----------
+# per-100g (kcal_min, kcal_max, protein_min, protein_max) by swap group
+PLAUSIBLE_RANGES = {
+    "lean_proteins":         (90, 260, 18,  float("inf")),
+    "whole_grains_starches": (60, 190, 1,   12),
+    "breads":                (180, 340, 3,  18),
+    "green_vegetables":      (10, 80,  0.3, 7),
+    "dairy_nondairy":        (15, 350, 0,   30),   # widened for cheese/yogurt
+}
+
 def plausible(group, kcal, protein, desc=""):
     if kcal is None or protein is None: return False
     k, p = float(kcal), float(protein)
-    if group == "lean_proteins":         return 90 <= k <= 260 and p >= 18
-    if group == "whole_grains_starches": return 60 <= k <= 190 and 1 <= p <= 12
-    if group == "breads":                return 180 <= k <= 340 and 3 <= p <= 18
-    if group == "green_vegetables":      return 10  <= k <= 80  and 0.3 <= p <= 7
-    if group == "dairy_nondairy":        return 15  <= k <= 350 and 0   <= p <= 30   # widened for cheese/yogurt
-    return k > 0 and p >= 0
-
+    rng = PLAUSIBLE_RANGES.get(group)
+    if rng is None: return k > 0 and p >= 0
+    kmin, kmax, pmin, pmax = rng
+    return kmin <= k <= kmax and pmin <= p <= pmax
+
+BRANDED_WORDS = frozenset(("barilla","dave","killer bread","ezekiel","fairlife","almond"))
+BRAND_ROUTING_WORDS = frozenset(("barilla","dave","ezekiel","fairlife","almond"))
+# one compiled alternation per word list instead of a substring test per word
+BRAND_RE         = re.compile("|".join(map(re.escape, sorted(BRANDED_WORDS))), re.I)
+BRAND_ROUTING_RE = re.compile("|".join(map(re.escape, sorted(BRAND_ROUTING_WORDS))), re.I)
+BARILLA_RE       = re.compile(r"barilla", re.I)
+DRY_RE           = re.compile(r"\b(dry|uncooked|unprepared)\b", re.I)
+
+@lru_cache(maxsize=None)
 def prefer_order(name, group):
-    branded_words = ["barilla","dave","killer bread","ezekiel","fairlife","almond"]
-    low = name.lower()
     if group in ("lean_proteins","whole_grains_starches","green_vegetables"):
-        return ["Foundation","SR Legacy","Survey (FNDDS)","Branded"]
-    if any(w in low for w in branded_words) or group in ("breads","dairy_nondairy"):
-        return ["Branded","Foundation","SR Legacy","Survey (FNDDS)"]
-    return ["Foundation","SR Legacy","Survey (FNDDS)","Branded"]
+        return ("Foundation","SR Legacy","Survey (FNDDS)","Branded")
+    if BRAND_RE.search(name) or group in ("breads","dairy_nondairy"):
+        return ("Branded","Foundation","SR Legacy","Survey (FNDDS)")
+    return ("Foundation","SR Legacy","Survey (FNDDS)","Branded")
 
 def is_branded_pasta_dry(food):
-    desc  = (food.get("description","") or "").lower()
-    owner = (food.get("brandOwner","") or "").lower()
-    dry_flags = ["dry","uncooked","unprepared"]
-    looks_dry = any(flag in desc for flag in dry_flags)
-    looks_brand = "barilla" in owner or "barilla" in desc
+    desc  = food.get("description","") or ""
+    owner = food.get("brandOwner","") or ""
+    looks_dry = DRY_RE.search(desc) is not None
+    looks_brand = BARILLA_RE.search(owner) is not None or BARILLA_RE.search(desc) is not None
     kcal, _ = per100_from_food(food)
     high_kcal = (kcal or 0) >= 280
     return looks_brand and (looks_dry or high_kcal)
@@ -213,25 +443,138 @@ def convert_dry_pasta_per100_to_cooked(kcal, protein, yield_factor=2.22):
     if kcal is None or protein is None: return kcal, protein
     return float(kcal)/yield_factor, float(protein)/yield_factor
 
-def pick_best_by_group(candidates, group, fallback_name):
-    def score(food):
-        kcal, pro = per100_from_food(food)
-        ok = plausible(group, kcal, pro, food.get("description",""))
-        hay = (food.get("description","") + " " + (food.get("brandOwner","") or "")).lower()
-        match = 2 if fallback_name.lower() in hay else 0
-        return (1 if ok else 0, match, float(food.get("score",0.0)))
-    candidates.sort(key=score, reverse=True)
-    return candidates[0] if candidates else None
+# ---------- name matching (Layer-1: rule-based, strictest key first) ----------
+STOPWORDS = frozenset(("cooked","raw","without","with","salt","drained","and","or","of","the"))
+
+# preparation states, most → least preferred when the ingredient doesn't name one
+PREP_STATES  = ("raw","fresh","dried","cooked","canned","frozen")
+COOKED_WORDS = frozenset(("cooked","boiled","baked","grilled","roasted","steamed","broiled","braised"))
+PROCESSING_WORDS = frozenset(PREP_STATES) | COOKED_WORDS | frozenset((
+    "drained","dry","heat","without","with","salt","enriched","unenriched","regular","plain","crumbles"))
+
+# synonyms/spellings folded together after stemming
+CONSOLIDATION = {"garbanzo": "chickpea", "prawn": "shrimp", "courgett": "zucchini", "courgette": "zucchini",
+                 "yoghurt": "yogurt", "emmer": "farro", "skim": "nonfat"}
+
+LAYER1_SCORES = (1000, 900, 800, 700)   # exact, processing-stripped, stemmed, consolidated
+
+@lru_cache(maxsize=None)
+def stem(word):
+    return _stem(word)
+
+@lru_cache(maxsize=None)
+def tokens(text):
+    return frozenset(re.findall(r"[a-z]+", text.lower())) - STOPWORDS
+
+@lru_cache(maxsize=None)
+def lemma_tokens(text):
+    return frozenset(_lemmatize(w) for w in tokens(text))
+
+def jaccard(query_tokens, cand_tokens):
+    # modified Jaccard |A∩B|/|A|: share of the query's tokens found in the candidate
+    return len(query_tokens & cand_tokens) / len(query_tokens) if query_tokens else 0.0
+
+def _words(text):
+    return re.findall(r"[a-z]+", text.lower())
+
+def _key(words):
+    return " ".join(sorted(set(words)))
+
+@lru_cache(maxsize=None)
+def layer1_keys(text):
+    """Order-insensitive match keys for a phrase, one per level in LAYER1_SCORES."""
+    words = _words(text)
+    core  = [w for w in words if w not in PROCESSING_WORDS and w not in STOPWORDS]
+    stems = [stem(w) for w in core]
+    return (_key(words), _key(core), _key(stems), _key(CONSOLIDATION.get(w, w) for w in stems))
+
+@lru_cache(maxsize=None)
+def prep_states(text):
+    return frozenset("cooked" if w in COOKED_WORDS else w for w in _words(text)
+                     if w in COOKED_WORDS or w in PREP_STATES)
+
+def prep_rank(states, wanted):
+    """Lower is better: match the ingredient's own state, else follow PREP_STATES order."""
+    if wanted:
+        return 0 if states & wanted else (1 if not states else 2)
+    return min((PREP_STATES.index(st) for st in states), default=0)
+
+def layer1_index(candidates):
+    """Inverted index (level, key) → candidate positions over each comma-segment prefix of the descriptions."""
+    index = {}
+    for i, food in enumerate(candidates):
+        segs = [seg for seg in (food.get("description","") or "").split(",") if seg.strip()]
+        for n in range(1, len(segs) + 1):
+            for level, key in enumerate(layer1_keys(",".join(segs[:n]))):
+                if key: index.setdefault((level, key), set()).add(i)
+    return index
+
+def layer1_match(name, candidates, datasets=()):
+    """Rank search hits by (prep state not contradicted, match score, prep-state preference, dataset preference,
+    head-segment substring, USDA score).
+
+    Search hits carry no nutrients we read, so plausibility is checked later on the fetched food record.
+
+    Below the layer-1 levels the match score is 500*jaccard over the query's non-processing tokens; a
+    query phrase found in the first comma segment only breaks ties inside that score, so it can't lift
+    a product that merely mentions the ingredient ("Babyfood, green beans and turkey") over one that
+    covers every query token. When `datasets` (prefer order) ranks Branded last, Branded rows get no
+    layer-1 level credit: short branded titles ("GRILLED CHICKEN BREAST") would otherwise hit the
+    stripped key and outrank the generic SR Legacy/Foundation row that covers the same tokens. A row
+    whose stated prep contradicts the query's ("raw" for a cooked item) ranks below every other row,
+    since its per-100g values describe a different food.
+    """
+    index  = layer1_index(candidates)
+    levels = {}
+    for level, key in enumerate(layer1_keys(name)):
+        for i in index.get((level, key), ()):
+            levels.setdefault(i, LAYER1_SCORES[level])
+    want    = lemma_tokens(name) - PROCESSING_WORDS
+    phrase  = " ".join(w for w in _words(name) if w not in PROCESSING_WORDS and w not in STOPWORDS)
+    wanted  = prep_states(name)
+    rank    = {dt: i for i, dt in enumerate(datasets)}
+    branded_last = bool(datasets) and datasets[-1] == "Branded"
+
+    def score(item):
+        i, food = item
+        desc = food.get("description","") or ""
+        dt   = food.get("dataType")
+        match = None if branded_last and dt == "Branded" else levels.get(i)
+        if match is None:
+            match = 500*jaccard(want, lemma_tokens(desc + " " + (food.get("brandOwner","") or "")))
+        head  = " ".join(_words(desc.split(",", 1)[0]))
+        substr = 1 if phrase and phrase in head else 0
+        prep  = prep_rank(prep_states(desc), wanted)
+        return (not (wanted and prep == 2), match, -prep, -rank.get(dt, len(rank)), substr,
+                float(food.get("score",0.0)))
+    return [food for _, food in sorted(enumerate(candidates), key=score, reverse=True)]
+
+def pick_best_by_group(candidates, group, fallback_name, datasets=()):
+    ranked = layer1_match(fallback_name, candidates, datasets)
+    return ranked[0] if ranked else None
 
 # ---------- resume helpers ----------
 def load_existing_catalog():
     if not os.path.exists(OUT): return {}
     try:
-        with open(OUT,"r") as f: data = json.load(f)
+        with open(OUT,"rb") as f: data = json_loads(f.read())
         return data.get("ingredients", {})
     except Exception:
         return {}
 
+def load_partial():
+    """Entries finished by an interrupted run (a torn last line is ignored)."""
+    if not os.path.exists(PARTIAL): return {}
+    done = {}
+    with open(PARTIAL,"rb") as f:   # bytes, so a line torn mid-UTF-8 fails inside json_loads, not in the read
+        for line in f:
+            try:
+                rec = json_loads(line)
+            except ValueError:
+                continue
+            done[rec["key"]] = rec["entry"]
+    return done
+
 def already_good(entry, group):
     try:
         per100 = entry.get("per100", {})
@@ -239,6 +582,7 @@ def already_good(entry, group):
     except Exception:
         return False
 
+@lru_cache(maxsize=None)
 def cookedify_query(group, name, is_branded_like=False):
     low = name.lower()
     if is_branded_like or group in ("breads","dairy_nondairy"): return name
@@ -246,6 +590,102 @@ def cookedify_query(group, name, is_branded_like=False):
         return name + " cooked"
     return name
 
+# ---------- per-item worker ----------
+def process_item(group, it, existing):
+    """Resolve one seed item; returns (key, entry, status) with status in skip/ok/warn/fallback."""
+    key, display_name = it["key"], it["name"]
+    desired_fdcId = str(it.get("fdcId") or "").strip() or None
+
+    # Fast path: keep plausible existing values (speeds up rebuilds)
+    if key in existing and already_good(existing[key], group):
+        log(f"[SKIP] {key} already plausible")
+        return key, existing[key], "skip"
+
+    # Fast path: pinned values win anyway, so don't spend HTTP calls on a search
+    if key in PINNED_OVERRIDES and not it.get("force_search"):
+        ovr = PINNED_OVERRIDES[key]
+        log(f"[PIN-FAST] {key} → per100 {{'kcal': {ovr['kcal']}, 'protein': {ovr['protein']}}}")
+        return key, {
+            "name": display_name,
+            "fdcId": desired_fdcId or "",
+            "per100": {"kcal": round(float(ovr["kcal"]),2), "protein": round(float(ovr["protein"]),2)},
+            "conversions": {},
+            "tags": ["pinned"]
+        }, "ok"
+
+    food = None; fdcId = desired_fdcId; status = "ok"
+
+    # 0) direct by FDC ID (cached)
+    if fdcId:
+        try:
+            food = fetch_by_id(fdcId)
+            kcal, pro = per100_from_food(food)
+            if not plausible(group, kcal, pro): food=None
+        except Exception:
+            food=None
+
+    # brand routing
+    branded_like = BRAND_ROUTING_RE.search(display_name) is not None
+
+    # 1) search — NORMAL mode does a deeper pass; QUICK does a minimal pass
+    base_q = NAME_HINTS.get(key) or display_name
+    q1 = cookedify_query(group, base_q, branded_like)
+    datasets = prefer_order(display_name, group)
+    if QUICK_MODE:
+        cand = search_by_name(q1, ("Foundation","SR Legacy","Branded"), page_size=12)
+    else:
+        cand = search_by_name(q1, datasets, page_size=30)
+    best = pick_best_by_group(cand, group, base_q, datasets)
+    if best:
+        try:
+            fdcId = str(best.get("fdcId"))
+            food  = fetch_by_id(fdcId)
+        except Exception:
+            food = None
+
+    # nutrients
+    kcal, protein = per100_from_food(food) if food else (None, None)
+
+    # special-case: branded dry pasta → convert to cooked if needed
+    if food and group == "whole_grains_starches" and "pasta" in display_name.lower():
+        if BARILLA_RE.search(food.get("brandOwner","") or "") or BARILLA_RE.search(food.get("description","") or ""):
+            kc0, pr0 = kcal, protein
+            if (protein or 0) < 8 or (kcal or 0) >= 270:
+                kcal, protein = convert_dry_pasta_per100_to_cooked(kcal, protein)
+            # sanity after conversion
+            if not (120 <= (kcal or 0) <= 190 and 5 <= (protein or 0) <= 12):
+                kcal, protein = kc0, pr0
+
+    # accept or fallback
+    if not plausible(group, kcal, protein):
+        fb = SAFE_FALLBACKS.get(key)
+        if fb:
+            kcal, protein = fb["kcal"], fb["protein"]
+            tag = "QUICK-FB" if QUICK_MODE else "FALLBACK"
+            log(f"[{tag}] {key} → per100 {{'kcal': {kcal}, 'protein': {protein}}}")
+            status = "fallback"
+        else:
+            log(f"[WARN] {key} unresolved → zeros")
+            status = "warn"
+            kcal = kcal or 0; protein = protein or 0
+    else:
+        log(f"[OK] {key} → FDC {fdcId} | {{'kcal': {round(float(kcal),2)}, 'protein': {round(float(protein),2)}}}")
+
+    # ----- PINNED OVERRIDES (always applied last; only reached with "force_search") -----
+    if key in PINNED_OVERRIDES:
+        ovr = PINNED_OVERRIDES[key]
+        kcal = ovr["kcal"]; protein = ovr["protein"]
+        log(f"[PIN] {key} forced override → per100 {{'kcal': {kcal}, 'protein': {protein}}}")
+
+    entry = {
+        "name": display_name,
+        "fdcId": fdcId or "",
+        "per100": {"kcal": round(float(kcal or 0),2), "protein": round(float(protein or 0),2)},
+        "conversions": {},
+        "tags": []
+    }
+    return key, entry, status
+
 # ---------- main ----------
 def main():
     mode = "QUICK" if QUICK_MODE else "NORMAL"
@@ -253,107 +693,50 @@ def main():
     if API_KEY == "REPLACE_WITH_YOUR_KEY":
         print("[ERROR] Add your USDA API key (set FDC_API_KEY or edit the script)."); sys.exit(1)
 
-    with open(SEED,"r") as f:
-        seed = json.load(f)
+    with open(SEED,"rb") as f:
+        seed = json_loads(f.read())
 
     existing = load_existing_catalog()
-    ingredients_out = {}; swapGroups = {}
+    resumed = load_partial()
+    if resumed:
+        print(f"Resuming: {len(resumed)} item(s) from {PARTIAL}")
+        existing.update(resumed)
+    ingredients_out = {}; swapGroups = {group: [] for group in seed}
     count_skip=count_ok=count_warn=0
 
-    for group, items in seed.items():
-        swapGroups.setdefault(group, [])
-        for it in items:
-            key, display_name = it["key"], it["name"]
-            desired_fdcId = str(it.get("fdcId") or "").strip() or None
-
-            # Fast path: keep plausible existing values (speeds up rebuilds)
-            if key in existing and already_good(existing[key], group):
-                ingredients_out[key] = existing[key]
-                swapGroups[group].append(key)
-                count_skip += 1
-                print(f"[SKIP] {key} already plausible")
-                continue
-
-            food = None; fdcId = desired_fdcId
-
-            # 0) direct by FDC ID (cached)
-            if fdcId:
-                try:
-                    food = fetch_by_id(fdcId)
-                    kcal, pro = per100_from_food(food)
-                    if not plausible(group, kcal, pro): food=None
-                except Exception:
-                    food=None
-
-            # brand routing
-            branded_like = any(w in display_name.lower() for w in ("barilla","dave","ezekiel","fairlife","almond"))
-
-            # 1) search — NORMAL mode does a deeper pass; QUICK does a minimal pass
-            base_q = NAME_HINTS.get(key) or display_name
-            q1 = cookedify_query(group, base_q, branded_like)
-            datasets = prefer_order(display_name, group)
-            if QUICK_MODE:
-                cand = search_by_name(q1, ["Foundation","SR Legacy","Branded"], page_size=12)
-            else:
-                cand = search_by_name(q1, datasets, page_size=30)
-            best = pick_best_by_group(cand, group, display_name)
-            if best:
-                try:
-                    fdcId = str(best.get("fdcId"))
-                    food  = fetch_by_id(fdcId)
-                except Exception:
-                    food = None
-
-            # nutrients
-            kcal, protein = per100_from_food(food) if food else (None, None)
-
-            # special-case: branded dry pasta → convert to cooked if needed
-            if food and group == "whole_grains_starches" and "pasta" in display_name.lower():
-                owner = (food.get("brandOwner","") or "").lower()
-                if "barilla" in owner or "barilla" in (food.get("description","") or "").lower():
-                    kc0, pr0 = kcal, protein
-                    if (protein or 0) < 8 or (kcal or 0) >= 270:
-                        kcal, protein = convert_dry_pasta_per100_to_cooked(kcal, protein)
-                    # sanity after conversion
-                    if not (120 <= (kcal or 0) <= 190 and 5 <= (protein or 0) <= 12):
-                        kcal, protein = kc0, pr0
-
-            # accept or fallback
-            if not plausible(group, kcal, protein):
-                fb = SAFE_FALLBACKS.get(key)
-                if fb:
-                    kcal, protein = fb["kcal"], fb["protein"]
-                    tag = "QUICK-FB" if QUICK_MODE else "FALLBACK"
-                    print(f"[{tag}] {key} → per100 {{'kcal': {kcal}, 'protein': {protein}}}")
-                else:
-                    print(f"[WARN] {key} unresolved → zeros")
-                    count_warn += 1
-                    kcal = kcal or 0; protein = protein or 0
-            else:
-                print(f"[OK] {key} → FDC {fdcId} | {{'kcal': {round(float(kcal),2)}, 'protein': {round(float(protein),2)}}}")
-                count_ok += 1
-
-            # ----- PINNED OVERRIDES (always applied last) -----
-            if key in PINNED_OVERRIDES:
-                ovr = PINNED_OVERRIDES[key]
-                kcal = ovr["kcal"]; protein = ovr["protein"]
-                print(f"[PIN] {key} forced override → per100 {{'kcal': {kcal}, 'protein': {protein}}}")
-
-            # write item
-            ingredients_out[key] = {
-                "name": display_name,
-                "fdcId": fdcId or "",
-                "per100": {"kcal": round(float(kcal or 0),2), "protein": round(float(protein or 0),2)},
-                "conversions": {},
-                "tags": []
-            }
-            swapGroups[group].append(key)
-            _sleep()
-
-    # write outputs + cache
-    with open(OUT,"w") as f:
-        json.dump({"ingredients":ingredients_out,"swapGroups":swapGroups}, f, indent=2)
-    save_cache(CACHE_DB)
+    # items overlap on USDA latency; results are re-assembled in seed order below
+    jobs = [(group, it) for group, items in seed.items() for it in items]
+
+    # pinned fdcIds for items that will actually be rebuilt: fetch them in bulk up front
+    fetch_bulk(str(it.get("fdcId") or "").strip() for group, it in jobs
+               if it.get("fdcId") and not (it["key"] in existing and already_good(existing[it["key"]], group))
+               and (it["key"] not in PINNED_OVERRIDES or it.get("force_search")))
+    results = [None] * len(jobs)
+    with open(PARTIAL,"ab+") as partial, ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        if partial.tell():   # terminate a torn last line before appending
+            partial.seek(-1, os.SEEK_END)
+            if partial.read(1) != b"\n": partial.write(b"\n")
+        futures = {ex.submit(process_item, group, it, existing): i for i, (group, it) in enumerate(jobs)}
+        for fut in as_completed(futures):
+            i = futures[fut]
+            results[i] = key, entry, status = fut.result()
+            if status != "skip":
+                partial.write((json_dumps({"group": jobs[i][0], "key": key, "entry": entry}) + "\n").encode())
+                partial.flush()
+
+    for (group, _), (key, entry, status) in zip(jobs, results):
+        ingredients_out[key] = entry
+        swapGroups[group].append(key)
+        if status == "skip":   count_skip += 1
+        elif status == "ok":   count_ok += 1
+        elif status == "warn": count_warn += 1
+
+    # write outputs atomically, then drop the sidecar (cache rows were committed as fetched)
+    tmp = OUT + ".tmp"
+    with open(tmp,"w",encoding="utf-8") as f:
+        f.write(json_dumps({"ingredients":ingredients_out,"swapGroups":swapGroups}, indent=True))
+    os.replace(tmp, OUT)
+    os.remove(PARTIAL)
 
     total = count_ok + count_warn + count_skip
     print("\n===== USDA BUILD SUMMARY =====")
@@ -362,6 +745,7 @@ def main():
     print(f"OK:            {count_ok}")
     print(f"Warnings(0s):  {count_warn}")
     print(f"Skipped(plausible): {count_skip}")
+    print(f"HTTP calls:    {HTTP_STATS['calls']} ({HTTP_STATS['seconds']:.2f}s, {HTTP_STATS['not_modified']} not modified)")
     print(f"Cache file:    {CACHE}")
 
 if __name__ == "__main__":
@@ -0,0 +1,52 @@
+import os, sys, tempfile, unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+_TMP = tempfile.TemporaryDirectory()
+
+def setUpModule():
+    # the builder opens its SQLite cache in the cwd at import; keep that out of the repo
+    global b
+    os.chdir(_TMP.name)
+    sys.path.insert(0, HERE)
+    import build_catalog_from_usda as b
+
+def tearDownModule():
+    os.chdir(HERE)
+    _TMP.cleanup()
+
+def food(fdc_id, description, kcal, protein, data_type="SR Legacy", score=0.0):
+    # search-result shape (flat nutrientId/value)
+    return {"fdcId": fdc_id, "description": description, "dataType": data_type, "score": score,
+            "foodNutrients": [{"nutrientId": 1008, "nutrientNumber": "208", "unitName": "KCAL", "value": kcal},
+                              {"nutrientId": 1003, "nutrientNumber": "203", "unitName": "G", "value": protein}]}
+
+class Layer1MatchTest(unittest.TestCase):
+    def test_full_token_coverage_beats_phrase_in_unrelated_product(self):
+        babyfood = food(1, "Babyfood, green beans and turkey, strained", 51.0, 4.1, score=900.0)
+        snap     = food(2, "Beans, snap, green, cooked, boiled, drained, with salt", 35.0, 1.89, score=100.0)
+        best = b.pick_best_by_group([babyfood, snap], "green_vegetables", "green beans cooked")
+        self.assertEqual(best["fdcId"], 2)
+    def test_in_range_wheat_pasta_does_not_outrank_named_match(self):
+        wheat    = food(1, "Pasta, fresh-refrigerated, plain, cooked", 131.0, 5.15, score=900.0)
+        chickpea = food(2, "CHICKPEA PASTA, PENNE, CHICKPEA", 357.0, 21.4, data_type="Branded", score=100.0)
+        best = b.pick_best_by_group([wheat, chickpea], "whole_grains_starches", "pasta, chickpea cooked")
+        self.assertEqual(best["fdcId"], 2)
+    def test_short_branded_title_does_not_outrank_generic_row(self):
+        generic = food(1, "Chicken, broiler or fryers, breast, skinless, boneless, meat only, cooked, grilled",
+                       151.0, 30.5, score=100.0)
+        branded = food(2, "GRILLED CHICKEN BREAST, GRILLED", 110.0, 22.0, data_type="Branded", score=900.0)
+        datasets = b.prefer_order("chicken breast cooked", "lean_proteins")
+        best = b.pick_best_by_group([branded, generic], "lean_proteins", "chicken breast, cooked, grilled", datasets)
+        self.assertEqual(best["fdcId"], 1)
+
+class LoadPartialTest(unittest.TestCase):
+    def tearDown(self):
+        os.remove(b.PARTIAL)
+    def test_line_torn_mid_utf8_is_ignored(self):
+        with open(b.PARTIAL, "wb") as f:
+            f.write(b'{"group": "g", "key": "oats", "entry": {"kcal_100g": 379}}\n')
+            f.write(b'{"group": "g", "key": "jalape\xc3')
+        self.assertEqual(b.load_partial(), {"oats": {"kcal_100g": 379}})
+
+if __name__ == "__main__":
+    unittest.main()